@@ -3,17 +3,114 @@ from __future__ import annotations
 
 import json
 import os
+import shutil
+import socket
 import sys
 import time
 import sqlite3
-from datetime import datetime, timezone, timedelta
+import threading
+from datetime import date, timedelta
+from http.client import HTTPConnection, HTTPResponse, HTTPSConnection
 from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
-from urllib.error import HTTPError, URLError
-from urllib.request import Request, urlopen
+
+
+# Per-thread SQLite handle for the quota DB (sqlite3 connections are bound to their thread).
+_tls = threading.local()
+
+# Shared quota counters. Requests only touch these dicts; SQLite just persists them
+# (every _FLUSH_INTERVAL seconds and on shutdown) so counts survive a restart.
+_mem_lock = threading.Lock()
+_mem_day: dict[tuple[str, str], int] = {}  # (day, scope) -> count
+# Per-minute counts sit in a ring of _MINUTE_SLOTS buckets per scope (slot = minute % _MINUTE_SLOTS);
+# a bucket whose stored minute isn't the current one counts as empty, so nothing needs deleting.
+_MINUTE_SLOTS = 10
+_mem_minute: dict[tuple[str, int], tuple[int, int]] = {}  # (scope, slot) -> (minute, count)
+# Increments not yet written to SQLite; _flush_usage maps minutes to ring slots
+_dirty_day: dict[tuple[str, str], int] = {}  # (day, scope) -> increments
+_dirty_minute: dict[tuple[int, str], int] = {}  # (minute, scope) -> increments
+_FLUSH_INTERVAL = 5.0
+# scope -> (epoch seconds its window resets, minimum Retry-After, rate-limit headers), for scopes
+# known to be exhausted. Plain dict get/set are atomic, so readers and writers need no lock.
+_block_cache: dict[str, tuple[int, int, list[tuple[bytes, str]]]] = {}
+_EPOCH = date(1970, 1, 1)
+_day_cache: tuple[int, str] = (-1, "")  # (days since epoch, "YYYY-MM-DD")
+
+# Idle keep-alive connections to the Gemini API, reused across requests to skip the TCP/TLS handshake
+_UPSTREAM_HOST = "generativelanguage.googleapis.com"
+_UPSTREAM_POOL_SIZE = 16
+_upstream_lock = threading.Lock()
+_upstream_idle: list[HTTPConnection] = []
+# Caps concurrent Gemini calls so a burst of slow generations can't pile up without bound;
+# requests past the cap wait up to _UPSTREAM_SLOT_WAIT seconds for a slot, then get a 503.
+_UPSTREAM_MAX_CONCURRENCY = max(1, int(os.environ.get("GEMINI_MAX_CONCURRENCY", "32")))
+_UPSTREAM_SLOT_WAIT = 60
+_upstream_slots = threading.BoundedSemaphore(_UPSTREAM_MAX_CONCURRENCY)
+
+
+# Shared compact encoder (json.dumps builds a fresh JSONEncoder per call whenever options are passed)
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def _error_body(message: str) -> bytes:
+    return _JSON_ENCODER.encode({"error": {"message": message}}).encode("utf-8")
+
+
+# Fixed error bodies, encoded once
+_ERR_NOT_FOUND = _error_body("Not found")
+_ERR_NO_API_KEY = _error_body("Missing GEMINI_API_KEY env var. Start server with GEMINI_API_KEY=... python3 dev_server.py")
+_ERR_BAD_JSON = _error_body("Invalid JSON body")
+_ERR_BODY_TOO_LARGE = _error_body("Request body too large")
+_ERR_SITE_QUOTA = _error_body("Site quota exceeded. Try again later.")
+_ERR_MODEL_LIMIT = _error_body("Rate limit exceeded for requested model.")
+_ERR_ALL_MODELS_LIMIT = _error_body("Rate limit exceeded for all allowed models.")
+_ERR_NO_SOURCE = _error_body("sourceText is required")
+_ERR_SOURCE_TOO_LARGE = _error_body("sourceText too large")
+_ERR_UPSTREAM_JSON = _error_body("Upstream returned invalid JSON")
+_ERR_BAD_DECK = _error_body("Model output is not a valid deck JSON")
+_ERR_SERVER_BUSY = _error_body("Server busy. Try again later.")
 
 
 def _json_response(handler: SimpleHTTPRequestHandler, status: int, payload: dict) -> None:
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    _json_response_bytes(handler, status, _JSON_ENCODER.encode(payload).encode("utf-8"))
+
+
+# Rate-limit header names, pre-encoded for _send_headers
+_H_SCOPE = b"X-RateLimit-Scope"
+_H_RPD_LIMIT = b"X-RateLimit-RPD-Limit"
+_H_RPD_USED = b"X-RateLimit-RPD-Used"
+_H_RPM_LIMIT = b"X-RateLimit-RPM-Limit"
+_H_RPM_USED = b"X-RateLimit-RPM-Used"
+
+
+def _send_headers(handler: SimpleHTTPRequestHandler, pairs: list[tuple[bytes, str]]) -> None:
+    """
+    send_header() for each (name, value) pair, minus its per-call formatting and Connection
+    handling (not needed for these headers): the lines go straight into the header buffer.
+    """
+    handler._headers_buffer.extend([b"%s: %s\r\n" % (name, value.encode("latin-1")) for name, value in pairs])
+
+
+# Status line and fixed headers of a 200 JSON reply per handler class, built from the handler's own
+# protocol_version and version_string() as send_response() would; only Date and Content-Length vary.
+_prologue_200_json: dict[type, bytes] = {}
+
+
+def _json_response_bytes(handler: SimpleHTTPRequestHandler, status: int, body: bytes) -> None:
+    if status == 200:
+        # Hot path: headers and body go out in a single write
+        prologue = _prologue_200_json.get(type(handler))
+        if prologue is None:
+            prologue = _prologue_200_json[type(handler)] = (
+                f"{handler.protocol_version} 200 OK\r\n"
+                f"Server: {handler.version_string()}\r\n"
+                "Content-Type: application/json; charset=utf-8\r\n"
+            ).encode("latin-1")
+        handler.log_request(200)
+        handler.wfile.write(
+            b"%sDate: %s\r\nContent-Length: %d\r\n\r\n%s"
+            % (prologue, handler.date_time_string().encode("latin-1"), len(body), body)
+        )
+        return
     handler.send_response(status)
     handler.send_header("Content-Type", "application/json; charset=utf-8")
     handler.send_header("Content-Length", str(len(body)))
@@ -68,6 +165,27 @@ def _split_csv(value: str) -> list[str]:
     return [v.strip() for v in (value or "").split(",") if v and v.strip()]
 
 
+# Model / quota config, read from the environment once at startup
+_MODEL_LIMITS = _parse_model_limits()
+_ALLOWED_MODELS = frozenset(_split_csv(os.environ.get("GEMINI_ALLOWED_MODELS", "gemini-2.5-flash")) or ["gemini-2.5-flash"])
+_MARKCRAFT_MODELS = tuple(_split_csv(os.environ.get("GEMINI_MARKCRAFT_MODELS", "gemini-2.5-flash,gemini-2.5-flash-lite,gemini-3-flash")))
+_FLASHCRAFT_MODELS = tuple(_split_csv(os.environ.get("GEMINI_FLASHCRAFT_MODELS", "gemini-2.5-flash,gemini-2.5-flash-lite,gemini-3-flash")))
+# Largest POST body we read. sourceText is capped at 200_000 chars, which is up to ~1.2 MB
+# of JSON if the client \u-escapes non-ASCII text.
+_MAX_BODY_BYTES = 2 * 1024 * 1024
+# Optional global "site total" cap across ALL models
+_SITE_TOTAL_RPD_LIMIT = int(os.environ.get("SITE_TOTAL_RPD_LIMIT", "0"))
+_SITE_TOTAL_RPM_LIMIT = int(os.environ.get("SITE_TOTAL_RPM_LIMIT", "0"))
+
+
+def _str_field(body: dict, key: str) -> str:
+    """
+    body[key] stripped, or "" if it's missing or not a string.
+    """
+    value = body.get(key)
+    return value.strip() if isinstance(value, str) else ""
+
+
 def _extract_text_from_gemini(payload: dict) -> str:
     try:
         candidates = payload.get("candidates") or []
@@ -79,127 +197,325 @@ def _extract_text_from_gemini(payload: dict) -> str:
         return ""
 
 
+_JSON_DECODER = json.JSONDecoder()
+
+
 def _extract_json_object(text: str) -> dict | None:
     text = (text or "").strip()
-    if not text:
-        return None
-    # Fast path
-    if text.startswith("{") and text.endswith("}"):
-        try:
-            return json.loads(text)
-        except Exception:
-            pass
-    # Try to find the first {...} block
+    # Find the first {...} block; raw_decode does the bracket matching in C and
+    # ignores anything after the object, so prose/fences around it are fine.
     start = text.find("{")
-    if start < 0:
-        return None
-    depth = 0
-    for i in range(start, len(text)):
-        c = text[i]
-        if c == "{":
-            depth += 1
-        elif c == "}":
-            depth -= 1
-            if depth == 0:
-                chunk = text[start : i + 1]
-                try:
-                    return json.loads(chunk)
-                except Exception:
-                    return None
+    while start >= 0:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            start = text.find("{", start + 1)
+            continue
+        except RecursionError:
+            # Nested too deep to decode; every later candidate sits inside this one, so give up
+            return None
+        return obj if isinstance(obj, dict) else None
     return None
 
 
-class DevHandler(SimpleHTTPRequestHandler):
-    def _get_db(self) -> sqlite3.Connection:
-        db_path = os.environ.get("QUOTA_DB_PATH", ".quota.sqlite3")
-        conn = sqlite3.connect(db_path, timeout=5)
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute(
-            "CREATE TABLE IF NOT EXISTS usage_day (day TEXT NOT NULL, scope TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY(day, scope))"
+def _utc_day(t: int) -> str:
+    """
+    "YYYY-MM-DD" (UTC) for epoch seconds t; the string is only rebuilt when the day changes.
+    """
+    global _day_cache
+    epoch_day = t // 86400
+    cached = _day_cache
+    if cached[0] != epoch_day:
+        cached = (epoch_day, (_EPOCH + timedelta(days=epoch_day)).isoformat())
+        # Swapped as one tuple, so other threads see either the old or the new pair
+        _day_cache = cached
+    return cached[1]
+
+
+def _get_db() -> sqlite3.Connection:
+    conn = getattr(_tls, "conn", None)
+    if conn is not None:
+        return conn
+    db_path = os.environ.get("QUOTA_DB_PATH", ".quota.sqlite3")
+    # Autocommit mode: _flush_usage manages its own BEGIN IMMEDIATE / COMMIT.
+    conn = sqlite3.connect(db_path, timeout=5, isolation_level=None)
+    # Per-connection settings. The quota tables are small and losing the last few seconds of
+    # counts on a crash is fine, so WAL + synchronous=NORMAL (no fsync per commit) is enough.
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=30000;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-8000;")  # 8 MB page cache
+    conn.execute("PRAGMA mmap_size=67108864;")  # 64 MB
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS usage_day (day TEXT NOT NULL, scope TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY(day, scope))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS usage_minute_ring (scope TEXT NOT NULL, slot INTEGER NOT NULL, minute INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY(scope, slot))"
+    )
+    _tls.conn = conn
+    return conn
+
+
+def _load_usage() -> None:
+    """
+    Seed the in-memory counters with today's / this minute's rows from SQLite (call once at startup).
+    """
+    t = int(time.time())
+    day = _utc_day(t)
+    minute = t // 60
+    conn = _get_db()
+    # Pre-ring minute table from older versions; it only ever held the last few minutes
+    conn.execute("DROP TABLE IF EXISTS usage_minute")
+    day_rows = conn.execute("SELECT scope, count FROM usage_day WHERE day = ?", (day,)).fetchall()
+    minute_rows = conn.execute("SELECT scope, slot, count FROM usage_minute_ring WHERE minute = ?", (minute,)).fetchall()
+    with _mem_lock:
+        for scope, count in day_rows:
+            _mem_day[(day, scope)] = int(count)
+        for scope, slot, count in minute_rows:
+            _mem_minute[(scope, int(slot))] = (minute, int(count))
+
+
+def _flush_usage() -> None:
+    """
+    Write the increments accumulated since the last flush to SQLite in one transaction,
+    and drop past days' counters from memory.
+    """
+    day = _utc_day(int(time.time()))
+    with _mem_lock:
+        day_deltas = list(_dirty_day.items())
+        minute_deltas = list(_dirty_minute.items())
+        _dirty_day.clear()
+        _dirty_minute.clear()
+        for key in [k for k in _mem_day if k[0] < day]:
+            del _mem_day[key]
+    if not day_deltas and not minute_deltas:
+        return
+
+    conn = _get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.executemany(
+            "INSERT INTO usage_day(day, scope, count) VALUES(?,?,?) ON CONFLICT(day, scope) DO UPDATE SET count = count + excluded.count",
+            [(d, scope, n) for (d, scope), n in day_deltas],
         )
-        conn.execute(
-            "CREATE TABLE IF NOT EXISTS usage_minute (minute INTEGER NOT NULL, scope TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY(minute, scope))"
+        cur.executemany(
+            "INSERT INTO usage_minute_ring(scope, slot, minute, count) VALUES(?,?,?,?) ON CONFLICT(scope, slot) DO UPDATE SET "
+            "count = CASE WHEN minute = excluded.minute THEN count + excluded.count ELSE excluded.count END, minute = excluded.minute "
+            "WHERE excluded.minute >= minute",
+            [(scope, m % _MINUTE_SLOTS, m, n) for (m, scope), n in minute_deltas],
         )
-        return conn
+        cur.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            cur.execute("ROLLBACK")
+        # Put the deltas back so the next flush retries them
+        with _mem_lock:
+            for key, n in day_deltas:
+                _dirty_day[key] = _dirty_day.get(key, 0) + n
+            for key, n in minute_deltas:
+                _dirty_minute[key] = _dirty_minute.get(key, 0) + n
+        raise
+
+
+def _start_usage_flusher(interval: float = _FLUSH_INTERVAL) -> threading.Thread:
+    def run() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                _flush_usage()
+            except Exception as e:
+                print(f"Quota flush failed: {type(e).__name__}: {e}", file=sys.stderr, flush=True)
 
-    def _consume_limit(self, scope: str, rpd_limit: int, rpm_limit: int) -> tuple[bool, int, dict]:
-        """
-        Shared limits (all visitors share the same pool), per scope.
-        """
-        now = datetime.now(timezone.utc)
-        day = now.strftime("%Y-%m-%d")
-        minute = int(time.time() // 60)
+    thread = threading.Thread(target=run, name="quota-flush", daemon=True)
+    thread.start()
+    return thread
 
-        conn = self._get_db()
-        try:
-            cur = conn.cursor()
 
-            # Cleanup old minute buckets (keep last 10 minutes)
-            cur.execute("DELETE FROM usage_minute WHERE minute < ?", (minute - 10,))
+def _cached_block(scope: str, t: int) -> tuple[int, list[tuple[bytes, str]]] | None:
+    """
+    (retry_after, headers) if scope is known to be exhausted at epoch second t, else None.
+    """
+    block = _block_cache.get(scope)
+    if block is None or t >= block[0]:
+        return None
+    until, min_retry, headers = block
+    return max(min_retry, until - t), headers
 
-            cur.execute("SELECT count FROM usage_day WHERE day = ? AND scope = ?", (day, scope))
-            row = cur.fetchone()
-            day_count = int(row[0]) if row else 0
 
-            cur.execute("SELECT count FROM usage_minute WHERE minute = ? AND scope = ?", (minute, scope))
-            row = cur.fetchone()
-            minute_count = int(row[0]) if row else 0
+def _new_upstream_conn() -> HTTPConnection:
+    return HTTPSConnection(_UPSTREAM_HOST, timeout=60)
 
-            allowed = True
-            retry_after = 0
-            if rpd_limit > 0 and day_count >= rpd_limit:
-                allowed = False
-                # seconds until next UTC day boundary
-                next_midnight = (now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1))
-                retry_after = max(60, int((next_midnight - now).total_seconds()))
-            if allowed and rpm_limit > 0 and minute_count >= rpm_limit:
-                allowed = False
-                retry_after = max(1, 60 - int(time.time() % 60))
-
-            headers = {
-                "X-RateLimit-Scope": scope,
-                "X-RateLimit-RPD-Limit": str(rpd_limit),
-                "X-RateLimit-RPD-Used": str(day_count),
-                "X-RateLimit-RPM-Limit": str(rpm_limit),
-                "X-RateLimit-RPM-Used": str(minute_count),
-            }
 
-            if not allowed:
-                return False, retry_after, headers
+def _release_upstream_conn(conn: HTTPConnection, resp: HTTPResponse) -> None:
+    """
+    Return a connection to the idle pool once its response has been read to the end.
+    """
+    if resp.will_close:
+        conn.close()
+        return
+    with _upstream_lock:
+        if len(_upstream_idle) < _UPSTREAM_POOL_SIZE:
+            _upstream_idle.append(conn)
+            return
+    conn.close()
 
-            # Consume one unit
-            cur.execute(
-                "INSERT INTO usage_day(day, scope, count) VALUES(?,?,1) ON CONFLICT(day, scope) DO UPDATE SET count = count + 1",
-                (day, scope),
-            )
-            cur.execute(
-                "INSERT INTO usage_minute(minute, scope, count) VALUES(?,?,1) ON CONFLICT(minute, scope) DO UPDATE SET count = count + 1",
-                (minute, scope),
-            )
-            conn.commit()
 
-            # Update after increment
-            headers["X-RateLimit-RPD-Used"] = str(day_count + 1)
-            headers["X-RateLimit-RPM-Used"] = str(minute_count + 1)
-            return True, 0, headers
-        finally:
-            conn.close()
+def _upstream_post(path: str, body: bytes) -> tuple[HTTPConnection, HTTPResponse]:
+    """
+    POST to the Gemini API over a pooled keep-alive connection.
+    The caller must read the response fully and then call _release_upstream_conn (or close the connection).
+    """
+    with _upstream_lock:
+        conn = _upstream_idle.pop() if _upstream_idle else None
+    reused = conn is not None
+    if conn is None:
+        conn = _new_upstream_conn()
+    try:
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        return conn, conn.getresponse()
+    except (ConnectionResetError, BrokenPipeError):
+        # An idle connection may have been closed by the server; retry once on a fresh one
+        conn.close()
+        if not reused:
+            raise
+    except BaseException:
+        conn.close()
+        raise
+
+    conn = _new_upstream_conn()
+    try:
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        return conn, conn.getresponse()
+    except BaseException:
+        conn.close()
+        raise
+
 
-    def _pick_model(self, preferred: list[str], allowed: set[str]) -> tuple[str | None, dict[str, str] | None, int]:
+class DevHandler(SimpleHTTPRequestHandler):
+    # Per-recv socket timeout: drops a connection that goes completely quiet (e.g. a browser preconnect).
+    timeout = 30
+    # Total time a client gets to send its whole request (line, headers and body). The per-recv
+    # timeout alone doesn't stop a client that trickles a byte every few seconds (slowloris).
+    request_deadline = 60
+
+    def setup(self) -> None:
+        super().setup()
+        self._read_timer = threading.Timer(self.request_deadline, self._abort_slow_request)
+        self._read_timer.daemon = True
+        self._read_timer.start()
+
+    def _abort_slow_request(self) -> None:
+        # Runs on the timer thread; shutting down the read side makes the blocked read return EOF
+        try:
+            self.connection.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def parse_request(self) -> bool:
+        ok = super().parse_request()
+        if ok and self.command != "POST":
+            # Only POST has a body to wait for; do_POST stops the timer once it has read it
+            self._read_timer.cancel()
+        return ok
+
+    def finish(self) -> None:
+        self._read_timer.cancel()
+        super().finish()
+
+    def _consume_limit(self, scope: str, rpd_limit: int, rpm_limit: int) -> tuple[bool, int, list[tuple[bytes, str]]]:
+        """
+        Shared limits (all visitors share the same pool), per scope.
+        """
+        return self._consume_limits_batch([(scope, rpd_limit, rpm_limit)])[0]
+
+    def _consume_limits_batch(self, scopes: list[tuple[str, int, int]]) -> list[tuple[bool, int, list[tuple[bytes, str]]]]:
+        """
+        Check several (scope, rpd_limit, rpm_limit) entries under one lock and consume one unit
+        from each only if ALL of them have room. Returns (allowed, retry_after, headers) per entry.
+
+        Counts live in memory; _flush_usage() persists them to SQLite in the background.
+        """
+        t = int(time.time())
+
+        # Fast reject: a scope that hit its limit stays blocked until its window resets
+        cached = [_cached_block(scope, t) for scope, _, _ in scopes]
+        if any(c is not None for c in cached):
+            # Scopes not known to be blocked report as allowed (nothing consumed) with no usage headers
+            return [(False, c[0], c[1]) if c is not None else (True, 0, []) for c in cached]
+
+        day = _utc_day(t)
+        minute = t // 60
+        slot = minute % _MINUTE_SLOTS
+
+        counts = []
+        with _mem_lock:
+            for scope, rpd_limit, rpm_limit in scopes:
+                day_count = _mem_day.get((day, scope), 0)
+                bucket = _mem_minute.get((scope, slot))
+                minute_count = bucket[1] if bucket is not None and bucket[0] == minute else 0
+                allowed = not (rpd_limit > 0 and day_count >= rpd_limit) and not (rpm_limit > 0 and minute_count >= rpm_limit)
+                counts.append((allowed, day_count, minute_count))
+            if all(allowed for allowed, _, _ in counts):
+                # Consume one unit per scope
+                for i, (scope, _, _) in enumerate(scopes):
+                    day_key = (day, scope)
+                    minute_key = (minute, scope)
+                    _, day_count, minute_count = counts[i]
+                    counts[i] = (True, day_count + 1, minute_count + 1)
+                    _mem_day[day_key] = day_count + 1
+                    _mem_minute[(scope, slot)] = (minute, minute_count + 1)
+                    _dirty_day[day_key] = _dirty_day.get(day_key, 0) + 1
+                    _dirty_minute[minute_key] = _dirty_minute.get(minute_key, 0) + 1
+
+        results = []
+        for (scope, rpd_limit, rpm_limit), (allowed, day_count, minute_count) in zip(scopes, counts):
+            retry_after = 0
+            if not allowed:
+                if rpd_limit > 0 and day_count >= rpd_limit:
+                    # blocked until the next UTC day boundary; the header never says less than 60 s
+                    until = t + 86400 - t % 86400
+                    min_retry = 60
+                else:
+                    until = t + 60 - t % 60
+                    min_retry = 1
+                retry_after = max(min_retry, until - t)
+            headers = [
+                (_H_SCOPE, scope),
+                (_H_RPD_LIMIT, str(rpd_limit)),
+                (_H_RPD_USED, str(day_count)),
+                (_H_RPM_LIMIT, str(rpm_limit)),
+                (_H_RPM_USED, str(minute_count)),
+            ]
+            results.append((allowed, retry_after, headers))
+            if not allowed:
+                # Cached until the real window end, not the floored Retry-After
+                _block_cache[scope] = (until, min_retry, headers)
+        return results
+
+    def _pick_model(self, preferred: tuple[str, ...], allowed: frozenset[str]) -> tuple[str | None, list[tuple[bytes, str]] | None, int]:
         """
         Pick the first model that:
         - is allowed
         - has remaining quota (per-model scope)
         Returns (model, rate_limit_headers, retry_after_if_blocked).
         """
-        model_limits = _parse_model_limits()
         last_headers = None
         max_retry_after = 0
+        now = int(time.time())
         for model in preferred:
             if model not in allowed:
                 continue
-            rpd, rpm = model_limits.get(model, _default_model_limits(model))
-            ok, retry_after, headers = self._consume_limit(f"gemini:{model}", rpd, rpm)
+            scope = f"gemini:{model}"
+            blocked = _cached_block(scope, now)
+            if blocked is not None:
+                # Known to be exhausted for now: skip it without going through _consume_limit
+                retry_after, last_headers = blocked
+                max_retry_after = max(max_retry_after, retry_after)
+                continue
+            rpd, rpm = _MODEL_LIMITS.get(model) or _default_model_limits(model)
+            ok, retry_after, headers = self._consume_limit(scope, rpd, rpm)
             last_headers = headers
             max_retry_after = max(max_retry_after, retry_after)
             if ok:
@@ -219,20 +535,12 @@ class DevHandler(SimpleHTTPRequestHandler):
 
     def do_POST(self) -> None:  # noqa: N802
         if self.path not in ("/api/gemini", "/api/flashcraft/generate_deck"):
-            _json_response(self, 404, {"error": {"message": "Not found"}})
+            _json_response_bytes(self, 404, _ERR_NOT_FOUND)
             return
 
         api_key = os.environ.get("GEMINI_API_KEY", "").strip()
         if not api_key:
-            _json_response(
-                self,
-                500,
-                {
-                    "error": {
-                        "message": "Missing GEMINI_API_KEY env var. Start server with GEMINI_API_KEY=... python3 dev_server.py"
-                    }
-                },
-            )
+            _json_response_bytes(self, 500, _ERR_NO_API_KEY)
             return
 
         try:
@@ -240,92 +548,106 @@ class DevHandler(SimpleHTTPRequestHandler):
         except ValueError:
             length = 0
 
+        if length > _MAX_BODY_BYTES:
+            # Refuse before reading anything; the unread body means this connection can't be reused
+            self.close_connection = True
+            _json_response_bytes(self, 413, _ERR_BODY_TOO_LARGE)
+            return
+
         raw = self.rfile.read(length) if length > 0 else b"{}"
+        self._read_timer.cancel()
         try:
+            # Decode explicitly: json.loads(bytes) would also accept UTF-16/32 and a UTF-8 BOM,
+            # and the verbatim pass-through below must only forward plain UTF-8 JSON.
             body = json.loads(raw.decode("utf-8") or "{}")
         except Exception:
-            _json_response(self, 400, {"error": {"message": "Invalid JSON body"}})
+            body = None
+        if not isinstance(body, dict):
+            _json_response_bytes(self, 400, _ERR_BAD_JSON)
             return
 
-        allowed_models = set(_split_csv(os.environ.get("GEMINI_ALLOWED_MODELS", "gemini-2.5-flash")))
-        if not allowed_models:
-            allowed_models = {"gemini-2.5-flash"}
+        requested = _str_field(body, "model") if self.path == "/api/gemini" else ""
+        if requested and requested not in _ALLOWED_MODELS:
+            _json_response_bytes(self, 400, _error_body(f"Model not allowed: {requested}"))
+            return
 
-        # Optional global "site total" cap across ALL models
-        total_rpd_limit = int(os.environ.get("SITE_TOTAL_RPD_LIMIT", "0"))
-        total_rpm_limit = int(os.environ.get("SITE_TOTAL_RPM_LIMIT", "0"))
-        total_headers = {}
-        if total_rpd_limit > 0 or total_rpm_limit > 0:
-            ok_total, retry_after_total, total_headers = self._consume_limit("site_total", total_rpd_limit, total_rpm_limit)
+        # Optional global "site total" cap across ALL models; an explicitly requested model is
+        # checked in the same batch, so neither is consumed unless both have room.
+        site_total = _SITE_TOTAL_RPD_LIMIT > 0 or _SITE_TOTAL_RPM_LIMIT > 0
+        scopes = []
+        if site_total:
+            scopes.append(("site_total", _SITE_TOTAL_RPD_LIMIT, _SITE_TOTAL_RPM_LIMIT))
+        if requested:
+            rpd, rpm = _MODEL_LIMITS.get(requested) or _default_model_limits(requested)
+            scopes.append((f"gemini:{requested}", rpd, rpm))
+        results = self._consume_limits_batch(scopes) if scopes else []
+
+        total_headers = []
+        if site_total:
+            ok_total, retry_after_total, total_headers = results[0]
             if not ok_total:
                 self.send_response(429)
                 self.send_header("Content-Type", "application/json; charset=utf-8")
                 self.send_header("Retry-After", str(retry_after_total))
-                for k, v in total_headers.items():
-                    self.send_header(k, v)
+                _send_headers(self, total_headers)
                 self.end_headers()
-                self.wfile.write(json.dumps({"error": {"message": "Site quota exceeded. Try again later."}}, ensure_ascii=False).encode("utf-8"))
+                self.wfile.write(_ERR_SITE_QUOTA)
                 return
 
-        rl_headers = {}
+        # Both lists carry the same five X-RateLimit-* names; the per-model set wins when present
+        rl_headers = []
         if self.path == "/api/gemini":
-            requested = (body.get("model") or "").strip()
-            if requested and requested not in allowed_models:
-                _json_response(self, 400, {"error": {"message": f"Model not allowed: {requested}"}})
-                return
-
             if requested:
                 model = requested
-                rpd, rpm = _parse_model_limits().get(model, _default_model_limits(model))
-                ok, retry_after, rl_headers = self._consume_limit(f"gemini:{model}", rpd, rpm)
+                ok, retry_after, rl_headers = results[-1]
                 if not ok:
                     self.send_response(429)
                     self.send_header("Content-Type", "application/json; charset=utf-8")
                     self.send_header("Retry-After", str(retry_after))
-                    for k, v in {**total_headers, **rl_headers}.items():
-                        self.send_header(k, v)
+                    _send_headers(self, rl_headers or total_headers)
                     self.end_headers()
-                    self.wfile.write(json.dumps({"error": {"message": "Rate limit exceeded for requested model."}}, ensure_ascii=False).encode("utf-8"))
+                    self.wfile.write(_ERR_MODEL_LIMIT)
                     return
             else:
-                preferred = _split_csv(os.environ.get("GEMINI_MARKCRAFT_MODELS", "gemini-2.5-flash,gemini-2.5-flash-lite,gemini-3-flash"))
-                model, rl_headers, retry_after = self._pick_model(preferred, allowed_models)
+                model, rl_headers, retry_after = self._pick_model(_MARKCRAFT_MODELS, _ALLOWED_MODELS)
                 if not model:
                     self.send_response(429)
                     self.send_header("Content-Type", "application/json; charset=utf-8")
                     self.send_header("Retry-After", str(retry_after))
-                    for k, v in {**total_headers, **(rl_headers or {})}.items():
-                        self.send_header(k, v)
+                    _send_headers(self, rl_headers or total_headers)
                     self.end_headers()
-                    self.wfile.write(json.dumps({"error": {"message": "Rate limit exceeded for all allowed models."}}, ensure_ascii=False).encode("utf-8"))
+                    self.wfile.write(_ERR_ALL_MODELS_LIMIT)
                     return
 
-            payload = {
-                "contents": body.get("contents") or [],
-            }
-            if body.get("systemInstruction") is not None:
-                payload["systemInstruction"] = body.get("systemInstruction")
+            if body.get("contents") and body.keys() <= {"contents", "systemInstruction"} and body.get("systemInstruction", True) is not None:
+                # Client sent exactly what we'd forward (MarkCraft's usual request): skip the re-encode
+                upstream_body = raw
+            else:
+                payload = {
+                    "contents": body.get("contents") or [],
+                }
+                if body.get("systemInstruction") is not None:
+                    payload["systemInstruction"] = body.get("systemInstruction")
+                upstream_body = _JSON_ENCODER.encode(payload).encode("utf-8")
         else:
-            preferred = _split_csv(os.environ.get("GEMINI_FLASHCRAFT_MODELS", "gemini-2.5-flash,gemini-2.5-flash-lite,gemini-3-flash"))
-            model, rl_headers, retry_after = self._pick_model(preferred, allowed_models)
+            model, rl_headers, retry_after = self._pick_model(_FLASHCRAFT_MODELS, _ALLOWED_MODELS)
             if not model:
                 self.send_response(429)
                 self.send_header("Content-Type", "application/json; charset=utf-8")
                 self.send_header("Retry-After", str(retry_after))
-                for k, v in {**total_headers, **(rl_headers or {})}.items():
-                    self.send_header(k, v)
+                _send_headers(self, rl_headers or total_headers)
                 self.end_headers()
-                self.wfile.write(json.dumps({"error": {"message": "Rate limit exceeded for all allowed models."}}, ensure_ascii=False).encode("utf-8"))
+                self.wfile.write(_ERR_ALL_MODELS_LIMIT)
                 return
 
-            requirements = (body.get("requirements") or "").strip()
-            source_text = (body.get("sourceText") or "").strip()
+            requirements = _str_field(body, "requirements")
+            source_text = _str_field(body, "sourceText")
             total = int(body.get("totalCards") or 60)
             if not source_text:
-                _json_response(self, 400, {"error": {"message": "sourceText is required"}})
+                _json_response_bytes(self, 400, _ERR_NO_SOURCE)
                 return
             if len(source_text) > 200_000:
-                _json_response(self, 413, {"error": {"message": "sourceText too large"}})
+                _json_response_bytes(self, 413, _ERR_SOURCE_TOO_LARGE)
                 return
             total = max(10, min(total, 200))
 
@@ -349,54 +671,78 @@ class DevHandler(SimpleHTTPRequestHandler):
                 "contents": [{"role": "user", "parts": [{"text": user_text}]}],
                 "systemInstruction": {"parts": [{"text": system_text}]},
             }
+            upstream_body = _JSON_ENCODER.encode(payload).encode("utf-8")
 
-        endpoint = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
-        req = Request(
-            endpoint,
-            data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
-            headers={"Content-Type": "application/json"},
-            method="POST",
-        )
-
+        path = f"/v1beta/models/{model}:generateContent?key={api_key}"
+        if not _upstream_slots.acquire(timeout=_UPSTREAM_SLOT_WAIT):
+            _json_response_bytes(self, 503, _ERR_SERVER_BUSY)
+            return
         try:
-            with urlopen(req, timeout=60) as resp:
-                data = resp.read()
-                status = getattr(resp, "status", 200) or 200
-        except HTTPError as e:
-            data = e.read() if hasattr(e, "read") else b""
-            status = e.code
-        except URLError as e:
-            _json_response(self, 502, {"error": {"message": f"Upstream network error: {e.reason}"}})
+            # Only the wait for Gemini's answer holds a slot; relaying it to a slow client doesn't
+            conn, resp = _upstream_post(path, upstream_body)
+        except OSError as e:
+            _json_response_bytes(self, 502, _error_body(f"Upstream network error: {e}"))
             return
         except Exception as e:
-            _json_response(self, 502, {"error": {"message": f"Upstream error: {type(e).__name__}: {e}"}})
+            _json_response_bytes(self, 502, _error_body(f"Upstream error: {type(e).__name__}: {e}"))
             return
+        finally:
+            _upstream_slots.release()
+
+        status = resp.status
+        if self.path == "/api/gemini" and 200 <= status < 300:
+            # Pass-through: stream the upstream body instead of buffering it first
+            self._send_proxy_headers(status, resp.headers.get("Content-Length"), rl_headers or total_headers)
+            try:
+                shutil.copyfileobj(resp, self.wfile, 64 * 1024)
+            except Exception as e:
+                # Headers are already out; all we can do is cut the response short
+                conn.close()
+                self.close_connection = True
+                self.log_error("Upstream stream interrupted: %s: %s", type(e).__name__, e)
+                return
+            _release_upstream_conn(conn, resp)
+            return
+
+        try:
+            data = resp.read()
+        except Exception as e:
+            conn.close()
+            _json_response_bytes(self, 502, _error_body(f"Upstream error: {type(e).__name__}: {e}"))
+            return
+        _release_upstream_conn(conn, resp)
 
         # For FlashCraft deck generation: return the parsed deck JSON directly (not the full Gemini payload)
         if self.path == "/api/flashcraft/generate_deck" and 200 <= status < 300:
             try:
                 upstream = json.loads(data.decode("utf-8"))
             except Exception:
-                _json_response(self, 502, {"error": {"message": "Upstream returned invalid JSON"}})
+                _json_response_bytes(self, 502, _ERR_UPSTREAM_JSON)
                 return
 
             text = _extract_text_from_gemini(upstream)
             deck = _extract_json_object(text)
             if not deck or not isinstance(deck, dict) or not isinstance(deck.get("cards"), list):
-                _json_response(self, 502, {"error": {"message": "Model output is not a valid deck JSON"}})
+                _json_response_bytes(self, 502, _ERR_BAD_DECK)
                 return
             _json_response(self, 200, {"title": deck.get("title", ""), "desc": deck.get("desc", ""), "cards": deck.get("cards", [])})
             return
 
+        self._send_proxy_headers(status, str(len(data)), rl_headers or total_headers)
+        self.wfile.write(data)
+
+    def _send_proxy_headers(self, status: int, content_length: str | None, extra_headers: list[tuple[bytes, str]]) -> None:
         self.send_response(status)
         self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(data)))
+        if content_length is not None:
+            self.send_header("Content-Length", content_length)
+        else:
+            # No length known up front: the body ends when the connection closes
+            self.close_connection = True
         # If you want to open this to other origins, keep these; for same-origin they're harmless.
         self.send_header("Access-Control-Allow-Origin", "*")
-        for k, v in {**total_headers, **rl_headers}.items():
-            self.send_header(k, v)
+        _send_headers(self, extra_headers)
         self.end_headers()
-        self.wfile.write(data)
 
 
 def main() -> int:
@@ -412,11 +758,17 @@ def main() -> int:
     print("  GEMINI_FLASHCRAFT_MODELS=gemini-2.5-flash,gemini-2.5-flash-lite,gemini-3-flash", flush=True)
     print("Per-model limits override: GEMINI_MODEL_LIMITS_JSON='{\"gemini-2.5-flash\":{\"rpd\":20,\"rpm\":5}}'", flush=True)
     print("Optional site-total cap: SITE_TOTAL_RPD_LIMIT=0 SITE_TOTAL_RPM_LIMIT=0", flush=True)
+    print(f"Concurrent Gemini calls: GEMINI_MAX_CONCURRENCY={_UPSTREAM_MAX_CONCURRENCY}", flush=True)
+    _load_usage()
+    _start_usage_flusher()
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\nStopping...", flush=True)
         return 0
+    finally:
+        server.server_close()
+        _flush_usage()
 
 
 if __name__ == "__main__":